@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (c) Vicent Marti. All rights reserved.
 #
@@ -6,9 +6,28 @@
 # For full terms see the included COPYING file.
 #
 
-from __future__ import with_statement
-from string import Template
-import re, fnmatch, os, sys, codecs, pickle
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import re, os, sys, pickle
+
+SKIP_COMMENTS_REGEX = re.compile(
+    br'(//.*?$|/\*.*?\*/)|(\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*")',
+    re.DOTALL | re.MULTILINE)
+
+TEST_FUNC_REGEX = br"^(void\s+(test_%s__([\w\x80-\xff]+))\s*\(\s*void\s*\))\s*\{"
+
+# Bump whenever the pickled Module layout changes
+CACHE_VERSION = 1
+
+Callback = namedtuple('Callback', 'short_name declaration symbol')
+
+SUITE_INFO_FORMAT = r"""
+    {
+        "%s",
+    %s,
+    %s,
+        _clar_cb_%s, %d, %d
+    }"""
 
 class Module(object):
     class Template(object):
@@ -18,19 +37,15 @@ class Module(object):
         def _render_callback(self, cb):
             if not cb:
                 return '    { NULL, NULL }'
-            return '    { "%s", &%s }' % (cb['short_name'], cb['symbol'])
+            return '    { "%s", &%s }' % (cb.short_name, cb.symbol)
 
     class DeclarationTemplate(Template):
         def render(self):
-            out = "\n".join("extern %s;" % cb['declaration'] for cb in self.module.callbacks) + "\n"
-
-            for initializer in self.module.initializers:
-                out += "extern %s;\n" % initializer['declaration']
-
+            callbacks = self.module.callbacks + self.module.initializers
             if self.module.cleanup:
-                out += "extern %s;\n" % self.module.cleanup['declaration']
+                callbacks.append(self.module.cleanup)
 
-            return out
+            return "".join(["extern %s;\n" % cb.declaration for cb in callbacks])
 
     class CallbacksTemplate(Template):
         def render(self):
@@ -49,30 +64,25 @@ class Module(object):
 
             for initializer in initializers:
                 name = self.module.clean_name()
-                if initializer and initializer['short_name'].startswith('initialize_'):
-                    variant = initializer['short_name'][len('initialize_'):]
+                if initializer and initializer.short_name.startswith('initialize_'):
+                    variant = initializer.short_name[len('initialize_'):]
                     name += " (%s)" % variant.replace('_', ' ')
 
-                template = Template(
-            r"""
-    {
-        "${clean_name}",
-    ${initialize},
-    ${cleanup},
-        ${cb_ptr}, ${cb_count}, ${enabled}
-    }"""
-                ).substitute(
-                    clean_name = name,
-                    initialize = self._render_callback(initializer),
-                    cleanup = self._render_callback(self.module.cleanup),
-                    cb_ptr = "_clar_cb_%s" % self.module.name,
-                    cb_count = len(self.module.callbacks),
-                    enabled = int(self.module.enabled)
+                template = SUITE_INFO_FORMAT % (
+                    name,
+                    self._render_callback(initializer),
+                    self._render_callback(self.module.cleanup),
+                    self.module.name,
+                    len(self.module.callbacks),
+                    int(self.module.enabled)
                 )
                 templates.append(template)
 
             return ','.join(templates)
 
+    # Compiled TEST_FUNC_REGEX, keyed by module name
+    _regex_cache = {}
+
     def __init__(self, name):
         self.name = name
 
@@ -84,32 +94,46 @@ class Module(object):
         return self.name.replace("_", "::")
 
     def _skip_comments(self, text):
-        SKIP_COMMENTS_REGEX = re.compile(
-            r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
-            re.DOTALL | re.MULTILINE)
+        if b'/' not in text and b'"' not in text and b"'" not in text:
+            return text
 
-        def _replacer(match):
-            s = match.group(0)
-            return "" if s.startswith('/') else s
+        # comments match group 1 and are dropped; string
+        # literals match group 2 and are kept as-is
+        return SKIP_COMMENTS_REGEX.sub(br'\2', text)
 
-        return re.sub(SKIP_COMMENTS_REGEX, _replacer, text)
+    def _test_regex(self):
+        regex = Module._regex_cache.get(self.name)
+        if regex is None:
+            name = re.escape(self.name.encode('utf-8'))
+            regex = re.compile(TEST_FUNC_REGEX % name, re.MULTILINE)
+            Module._regex_cache[self.name] = regex
+        return regex
 
     def parse(self, contents):
-        TEST_FUNC_REGEX = r"^(void\s+(test_%s__(\w+))\s*\(\s*void\s*\))\s*\{"
-
-        contents = self._skip_comments(contents)
-        regex = re.compile(TEST_FUNC_REGEX % self.name, re.MULTILINE)
-
         self.callbacks = []
         self.initializers = []
         self.cleanup = None
 
-        for (declaration, symbol, short_name) in regex.findall(contents):
-            data = {
-                "short_name" : short_name,
-                "declaration" : declaration,
-                "symbol" : symbol
-            }
+        # Files that never mention this module's test prefix (helpers,
+        # a copied clar.c...) cannot define tests; skip scanning them
+        prefix = b"test_%s__" % self.name.encode('utf-8')
+        if prefix not in contents:
+            return False
+
+        contents = self._skip_comments(contents)
+        regex = self._test_regex()
+
+        # A test may be defined more than once (e.g. in different
+        # #ifdef branches); only register it the first time
+        seen = set()
+
+        for match in regex.finditer(contents):
+            declaration, symbol, short_name = (m.decode('utf-8') for m in match.groups())
+            if symbol in seen:
+                continue
+            seen.add(symbol)
+
+            data = Callback(short_name, declaration, symbol)
 
             if short_name.startswith('initialize'):
                 self.initializers.append(data)
@@ -133,7 +157,7 @@ class Module(object):
             self.modified = True
             self.mtime = st.st_mtime
 
-            with codecs.open(path, encoding='utf-8') as fp:
+            with open(path, 'rb') as fp:
                 raw_content = fp.read()
 
         except IOError:
@@ -156,20 +180,22 @@ class TestSuite(object):
 
         return False
 
-    def find_modules(self):
-        modules = []
-        for root, _, files in os.walk(self.path):
-            module_root = root[len(self.path):]
-            module_root = [c for c in module_root.split(os.sep) if c]
-
-            tests_in_module = fnmatch.filter(files, "*.c")
-
-            for test_file in tests_in_module:
-                full_path = os.path.join(root, test_file)
-                module_name = "_".join(module_root + [test_file[:-2]]).replace("-", "_")
+    def _find_modules(self, root, module_root, modules):
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            return
 
-                modules.append((full_path, module_name))
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self._find_modules(entry.path, module_root + [entry.name], modules)
+            elif entry.name.endswith('.c') and entry.is_file():
+                module_name = "_".join(module_root + [entry.name[:-2]]).replace("-", "_")
+                modules.append((entry.path, module_name))
 
+    def find_modules(self):
+        modules = []
+        self._find_modules(self.path, [], modules)
         return modules
 
     def load_cache(self):
@@ -178,8 +204,12 @@ class TestSuite(object):
 
         try:
             fp = open(path, 'rb')
-            cache = pickle.load(fp)
+            data = pickle.load(fp)
             fp.close()
+
+            # Caches from older versions are discarded
+            if isinstance(data, tuple) and data[0] == CACHE_VERSION:
+                cache = data[1]
         except (IOError, ValueError):
             pass
 
@@ -188,17 +218,26 @@ class TestSuite(object):
     def save_cache(self):
         path = os.path.join(self.output, '.clarcache')
         with open(path, 'wb') as cache:
-            pickle.dump(self.modules, cache)
+            pickle.dump((CACHE_VERSION, self.modules), cache)
 
     def load(self, force = False):
-        module_data = self.find_modules()
+        module_data = dict((name, path) for path, name in self.find_modules())
         self.modules = {} if force else self.load_cache()
 
-        for path, name in module_data:
+        for name in module_data:
             if name not in self.modules:
                 self.modules[name] = Module(name)
 
-            if not self.modules[name].refresh(path):
+        # Modules are independent, so read and parse them in parallel
+        # and only touch `self.modules` from this thread
+        def refresh(name):
+            return self.modules[name].refresh(module_data[name])
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(refresh, module_data))
+
+        for name, loaded in zip(module_data, results):
+            if not loaded:
                 del self.modules[name]
 
     def disable(self, excluded):
@@ -215,31 +254,42 @@ class TestSuite(object):
     def callback_count(self):
         return sum(len(module.callbacks) for module in self.modules.values())
 
+    @staticmethod
+    def _write_file(path, data):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        fd = os.open(path, flags, 0o666)
+        try:
+            data = memoryview(data)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
     def write(self):
         output = os.path.join(self.output, 'clar.suite')
 
         if not self.should_generate(output):
             return False
 
-        with open(output, 'w') as data:
-            modules = sorted(self.modules.values(), key=lambda module: module.name)
+        data = []
+        modules = sorted(self.modules.values(), key=lambda module: module.name)
 
-            for module in modules:
-                t = Module.DeclarationTemplate(module)
-                data.write(t.render())
+        for module in modules:
+            t = Module.DeclarationTemplate(module)
+            data.append(t.render())
 
-            for module in modules:
-                t = Module.CallbacksTemplate(module)
-                data.write(t.render())
+        for module in modules:
+            t = Module.CallbacksTemplate(module)
+            data.append(t.render())
 
-            suites = "static struct clar_suite _clar_suites[] = {" + ','.join(
-                Module.InfoTemplate(module).render() for module in modules
-            ) + "\n};\n"
+        data.append("static struct clar_suite _clar_suites[] = {")
+        data.append(",".join(Module.InfoTemplate(module).render() for module in modules))
+        data.append("\n};\n")
 
-            data.write(suites)
+        data.append("static const size_t _clar_suite_count = %d;\n" % self.suite_count())
+        data.append("static const size_t _clar_callback_count = %d;\n" % self.callback_count())
 
-            data.write("static const size_t _clar_suite_count = %d;\n" % self.suite_count())
-            data.write("static const size_t _clar_callback_count = %d;\n" % self.callback_count())
+        self._write_file(output, "".join(data).encode('utf-8'))
 
         self.save_cache()
         return True